@@ -1,4 +1,3 @@
-import re
 import argparse
 
 from rdkit import Chem, RDLogger
@@ -19,124 +18,58 @@ def export_file(suppl: list, output_path: str):
     output_path : str
         The path to the output file.
     """
-    writer = Chem.SDWriter(output_path)
-    
-    for mol in suppl:
-        props = mol.GetPropsAsDict()
-        writer.SetProps(list(props.keys()))  
-        
-        writer.write(mol)
-        
-    writer.close()
+    with open(output_path, 'w', buffering=1 << 20) as f:
+        # without SetProps the writer stores the public properties of each molecule
+        writer = Chem.SDWriter(f)
+        
+        for mol in suppl:
+            writer.write(mol)
+            
+        writer.close()
    
 
-def create_hydrogen_dataset(data_path: str):
-    suppl = Chem.SDMolSupplier(data_path, removeHs=False, sanitize=True)
-
-    dataset = []
-        
-    for mol in tqdm(suppl, desc="Validating dataset", total=len(suppl)):
-        # Check if the molecule is valid
-        if mol is None:
-            print(f"Invalid molecule found in {data_path}")
-            continue
-        
-        # get the properties of the molecule
-        prop_names = mol.GetPropNames(includePrivate=False, includeComputed=False)
-        has_spectrum = False
-        
-        for prop in prop_names:
-            pattern = r"^Spectrum 1H \d+$"
-            if bool(re.match(pattern, prop)):
-                has_spectrum = True
-                break
-        
-        if has_spectrum:
-            dataset.append(mol)
-        
-    print(f"Valid molecules found: {len(dataset)}")
-    
-    export_file(dataset, output_path='hydrogen_dataset.sdf')
-        
-
-def create_carbon_dataset(data_path: str):
+def has_spectrum(mol: Chem.rdchem.Mol, nucleus: str) -> bool:
     r"""
-    Creates a dataset of carbon spectra from a given sdf file.
+    Checks whether a molecule has a ``Spectrum <nucleus> <n>`` property.
     
     Parameters
     ----------
-    data_path : str
-        The path to the sdf file containing the carbon spectra.
+    mol : Chem.rdchem.Mol
+        The RDKit molecule to check.
+    nucleus : str
+        The nucleus of the spectrum, e.g. '13C'.
     """
-    suppl = Chem.SDMolSupplier(data_path, removeHs=False, sanitize=True)
-
-    dataset = []
-        
-    for mol in tqdm(suppl, desc="Validating dataset", total=len(suppl)):
-        # Check if the molecule is valid
-        if mol is None:
-            print(f"Invalid molecule found in {data_path}")
-            continue
-        # Only consider molecules with less than 50 atoms
-        if mol.GetNumAtoms() >= 40:
-            print(f"Invalid number of atoms found in {data_path}")
-            continue
-        # Only consider molecules with H, C, N, O, F, Si, P, S, Cl, Br, and I atoms
-        if not all(atom.GetAtomicNum() in [1, 6, 7, 8, 9, 14, 15, 16, 17, 35, 53] for atom in mol.GetAtoms()):
-            print(f"Invalid element found in {data_path}")
-            continue
-        
-        # get the properties of the molecule
-        prop_names = mol.GetPropNames(includePrivate=False, includeComputed=False)
-        # check if the molecule has a carbon spectrum
-        for prop in prop_names:
-            pattern = r"^Spectrum 13C \d+$"
-            if bool(re.match(pattern, prop)):
-                dataset.append(mol)
-                break
-            else:
-                continue
-        
-    print(f"Valid molecules found: {len(dataset)}")
+    prefix = f"Spectrum {nucleus} "
+    
+    for prop in mol.GetPropNames(includePrivate=False, includeComputed=False):
+        if prop.startswith(prefix) and prop[len(prefix):].isdigit():
+            return True
         
-    # export the dataset to a sdf file
-    export_file(dataset, output_path='carbon_dataset.sdf')
+    return False
 
 
-def create_fluorine_dataset(data_path: str):
+def is_valid_carbon_mol(mol: Chem.rdchem.Mol, data_path: str) -> bool:
     r"""
-    Creates a dataset of fluorine spectra from a given sdf file.
-    
-    Parameters
-    ----------
-    data_path : str
-        The path to the sdf file containing the fluorin spectra.
+    Checks the size and the elements of a molecule for the carbon dataset.
     """
-    suppl = Chem.SDMolSupplier(data_path, removeHs=False, sanitize=True)
+    # Only consider molecules with less than 40 atoms
+    if mol.GetNumAtoms() >= 40:
+        print(f"Invalid number of atoms found in {data_path}")
+        return False
+    # Only consider molecules with H, C, N, O, F, Si, P, S, Cl, Br, and I atoms
+    if not all(mol.GetAtomWithIdx(i).GetAtomicNum() in [1, 6, 7, 8, 9, 14, 15, 16, 17, 35, 53] for i in range(mol.GetNumAtoms())):
+        print(f"Invalid element found in {data_path}")
+        return False
+    
+    return True
 
-    dataset = []
-        
-    for mol in tqdm(suppl, desc="Validating dataset", total=len(suppl)):
-        # Check if the molecule is valid
-        if mol is None:
-            print(f"Invalid molecule found in {data_path}")
-            continue
-        
-        # get the properties of the molecule
-        prop_names = mol.GetPropNames(includePrivate=False, includeComputed=False)
-        # check if the molecule has a carbon spectrum
-        for prop in prop_names:
-            pattern = r"^Spectrum 19F \d+$"
-            if bool(re.match(pattern, prop)):
-                dataset.append(mol)
-                break
-            else:
-                continue
-        
-    print(f"Valid molecules found: {len(dataset)}")
-        
-    # export the dataset to a sdf file
-    export_file(dataset, output_path='fluorine_dataset.sdf')
+
+# element -> (nucleus, output path, extra molecule check)
+ELEMENTS = {
+    'carbon': ('13C', 'carbon_dataset.sdf', is_valid_carbon_mol),
+    'hydrogen': ('1H', 'hydrogen_dataset.sdf', None),
+    'fluorine': ('19F', 'fluorine_dataset.sdf', None),
+}
 
 
 def create_dataset(data_path: str, element: str = 'carbon'):
@@ -151,14 +84,33 @@ def create_dataset(data_path: str, element: str = 'carbon'):
         The element to create the dataset for.
         Options: 'carbon', 'hydrogen', 'fluorine'
     """
-    if element == 'carbon':
-        create_carbon_dataset(data_path=data_path)
-    elif element == 'hydrogen':
-        create_hydrogen_dataset(data_path=data_path)
-    elif element == 'fluorine':
-        create_fluorine_dataset(data_path=data_path)
-    else:
+    if element not in ELEMENTS:
         raise ValueError("Invalid element specified. Options: 'carbon', 'hydrogen', 'fluorine'")
+    
+    nucleus, output_path, is_valid_mol = ELEMENTS[element]
+    
+    dataset = []
+    
+    with open(data_path, 'rb') as f:
+        suppl = Chem.ForwardSDMolSupplier(f, removeHs=False, sanitize=True)
+        
+        for mol in tqdm(suppl, desc="Validating dataset", unit="mol"):
+            # Check if the molecule is valid
+            if mol is None:
+                print(f"Invalid molecule found in {data_path}")
+                continue
+            if is_valid_mol is not None and not is_valid_mol(mol, data_path):
+                continue
+            
+            # check if the molecule has a spectrum of the nucleus
+            if has_spectrum(mol, nucleus):
+                dataset.append(mol)
+        
+    print(f"Valid molecules found: {len(dataset)}")
+        
+    # export the dataset to a sdf file
+    export_file(dataset, output_path=output_path)
+
 
 if __name__ == "__main__":
     args = argparse.ArgumentParser()
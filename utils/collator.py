@@ -9,18 +9,17 @@ class GeoformerDataCollator:
         self.max_nodes = max_nodes
 
     @staticmethod
-    def _pad_feats(feats: torch.Tensor, max_node: int) -> torch.Tensor:
+    def _pad_feats(feats: torch.Tensor, feats_padded: torch.Tensor) -> None:
         N, *_ = feats.shape
-        if N <= max_node:
-            feats_padded = torch.zeros([max_node, *_], dtype=feats.dtype)
-            feats_padded[:N] = feats
-        else:
+        max_node = feats_padded.shape[0]
+        if N > max_node:
             print(
                 f"Warning: max_node {max_node} is too small to hold all nodes {N} in a batch"
             )
             print("Play truncation...")
+            feats = feats[:max_node]
 
-        return feats_padded
+        feats_padded[:feats.shape[0]] = feats
 
     def __call__(self, batch) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         graph_list, shift_list, masks_list = map(list, zip(*batch))
@@ -31,21 +30,17 @@ class GeoformerDataCollator:
             else self.max_nodes
         )
 
-        
-        batch_z = torch.stack(
-            [self._pad_feats(torch.LongTensor(graph.z), max_node) for graph in graph_list]
-        )
-
-        batch_pos = torch.stack(
-            [self._pad_feats(torch.FloatTensor(graph.pos), max_node) for graph in graph_list]
-        )
-
-        batch_label = torch.stack(
-            [self._pad_feats(torch.FloatTensor(shift), max_node) for shift in shift_list]
-        )
-
-        batch_mask = torch.stack(
-            [self._pad_feats(torch.BoolTensor(mask), max_node) for mask in masks_list]
-        )
+        # allocate the padded batch once and copy every graph into its row
+        batch_size = len(graph_list)
+        batch_z = torch.zeros([batch_size, max_node], dtype=torch.long)
+        batch_pos = torch.zeros([batch_size, max_node, 3], dtype=torch.float)
+        batch_label = torch.zeros([batch_size, max_node], dtype=torch.float)
+        batch_mask = torch.zeros([batch_size, max_node], dtype=torch.bool)
+
+        for i, (graph, shift, mask) in enumerate(zip(graph_list, shift_list, masks_list)):
+            self._pad_feats(graph.z, batch_z[i])
+            self._pad_feats(graph.pos, batch_pos[i])
+            self._pad_feats(shift, batch_label[i])
+            self._pad_feats(mask, batch_mask[i])
 
         return batch_z, batch_pos, batch_label, batch_mask
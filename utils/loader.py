@@ -1,16 +1,112 @@
 import os
-import ast
 import torch
+import multiprocessing as mp
 import numpy as np
 
+from functools import lru_cache
 from rdkit import Chem, RDLogger
 from tqdm import tqdm
 from torch.utils.data import Dataset
 from torch_geometric.data import InMemoryDataset, Data
-from ogb.utils.features import atom_to_feature_vector, bond_to_feature_vector
+from ogb.utils import features as ogb_features
+from ogb.utils.features import allowable_features, safe_index
 
 RDLogger.DisableLog('rdApp.*')
 
+# widths of the OGB atom and bond feature vectors
+NUM_ATOM_FEATURES = 9  # see ogb.utils.features.atom_to_feature_vector
+NUM_BOND_FEATURES = 3  # bond type, bond stereo, is_conjugated
+
+
+def iter_mol_blocks(path: str):
+    r"""
+    Iterate over the records of an sdf file as raw strings.
+
+    Each record keeps its data fields and the ``$$$$`` terminator, so it can
+    be shipped to a worker process and parsed there.
+    """
+    block = []
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            block.append(line)
+            if line.startswith('$$$$'):
+                yield ''.join(block)
+                block = []
+
+    # the last record may miss its terminator
+    if any(line.strip() for line in block):
+        yield ''.join(block)
+
+
+@lru_cache(maxsize=None)
+def encode_atom(atomic_num, chiral_tag, degree, formal_charge, num_hs, num_radical_e, hybridization, is_aromatic, is_in_ring):
+    r"""
+    Encode the raw properties of an atom the same way as
+    ``ogb.utils.features.atom_to_feature_vector``.
+
+    Molecules repeat the same few atom environments, so the encodings are
+    memoized on the raw properties.
+    """
+    return (
+        safe_index(allowable_features['possible_atomic_num_list'], atomic_num),
+        allowable_features['possible_chirality_list'].index(str(chiral_tag)),
+        safe_index(allowable_features['possible_degree_list'], degree),
+        safe_index(allowable_features['possible_formal_charge_list'], formal_charge),
+        safe_index(allowable_features['possible_numH_list'], num_hs),
+        safe_index(allowable_features['possible_number_radical_e_list'], num_radical_e),
+        safe_index(allowable_features['possible_hybridization_list'], str(hybridization)),
+        allowable_features['possible_is_aromatic_list'].index(is_aromatic),
+        allowable_features['possible_is_in_ring_list'].index(is_in_ring),
+    )
+
+
+def atom_to_feature_vector(atom):
+    r"""
+    Drop-in replacement for ``ogb.utils.features.atom_to_feature_vector``
+    backed by the memoized :func:`encode_atom`.
+    """
+    return encode_atom(
+        atom.GetAtomicNum(),
+        atom.GetChiralTag(),
+        atom.GetTotalDegree(),
+        atom.GetFormalCharge(),
+        atom.GetTotalNumHs(),
+        atom.GetNumRadicalElectrons(),
+        atom.GetHybridization(),
+        atom.GetIsAromatic(),
+        atom.IsInRing(),
+    )
+
+
+def enum_lut(name, enum):
+    r"""
+    Map the RDKit enum values listed in an OGB feature list to their positions.
+    """
+    return {getattr(enum, value): i for i, value in enumerate(allowable_features[name]) if hasattr(enum, value)}
+
+
+BOND_TYPE_LUT = enum_lut('possible_bond_type_list', Chem.rdchem.BondType)
+BOND_STEREO_LUT = enum_lut('possible_bond_stereo_list', Chem.rdchem.BondStereo)
+IS_CONJUGATED_LUT = {value: i for i, value in enumerate(allowable_features['possible_is_conjugated_list'])}
+
+
+def bond_to_feature_vector(bond):
+    r"""
+    Table-driven version of ``ogb.utils.features.bond_to_feature_vector``.
+
+    Bonds are not memoized like atoms, so their enums are looked up directly
+    instead of being converted to strings and searched for in OGB's lists.
+    Values missing from the tables fall back to the OGB encoder.
+    """
+    try:
+        return (
+            BOND_TYPE_LUT[bond.GetBondType()],
+            BOND_STEREO_LUT[bond.GetStereo()],
+            IS_CONJUGATED_LUT[bond.GetIsConjugated()],
+        )
+    except KeyError:
+        return ogb_features.bond_to_feature_vector(bond)
+
 
 class DatasetBuilder:
     def __init__(self, root):
@@ -36,7 +132,8 @@ class DatasetBuilder:
     
     @property
     def processed_file_names(self):
-        return "processed.pt"
+        # the collated format has its own name, so caches in the old format are rebuilt
+        return "processed_v2.pt"
     
     @property
     def processed_paths(self):
@@ -44,57 +141,116 @@ class DatasetBuilder:
 
     def mol2graph(self, mol):
         # atoms
-        atom_features_list = []
-        for atom in mol.GetAtoms():
-            atom_features_list.append(atom_to_feature_vector(atom))
-
-        x = np.array(atom_features_list, dtype=np.int64)
+        num_atoms = mol.GetNumAtoms()
 
-        coords = mol.GetConformer().GetPositions()
-        z = [atom.GetAtomicNum() for atom in mol.GetAtoms()]
+        # fill the per-atom arrays in a single pass over the atoms
+        x = np.empty((num_atoms, NUM_ATOM_FEATURES), dtype=np.int64)
+        z = np.empty(num_atoms, dtype=np.int64)
+        for i in range(num_atoms):
+            atom = mol.GetAtomWithIdx(i)
+            x[i] = atom_to_feature_vector(atom)
+            z[i] = atom.GetAtomicNum()
 
         # bonds
-        num_bond_features = 3  # bond type, bond stereo, is_conjugated
-        if len(mol.GetBonds()) > 0:  # mol has bonds
-            edge_features_list = []
-            edges_list = []
-            for bond in mol.GetBonds():
+        num_bonds = mol.GetNumBonds()
+        if num_bonds > 0:  # mol has bonds
+            # data.edge_index: Graph connectivity in COO format with shape [2, num_edges]
+            edge_index = np.empty((2, 2 * num_bonds), dtype=np.int64)
+            # data.edge_attr: Edge feature matrix with shape [num_edges, num_edge_features]
+            edge_attr = np.empty((2 * num_bonds, NUM_BOND_FEATURES), dtype=np.int64)
+
+            for k in range(num_bonds):
+                bond = mol.GetBondWithIdx(k)
                 i = bond.GetBeginAtomIdx()
                 j = bond.GetEndAtomIdx()
 
                 edge_feature = bond_to_feature_vector(bond)
 
                 # add edges in both directions
-                edges_list.append((i, j))
-                edge_features_list.append(edge_feature)
-                edges_list.append((j, i))
-                edge_features_list.append(edge_feature)
-
-            # data.edge_index: Graph connectivity in COO format with shape [2, num_edges]
-            edge_index = np.array(edges_list, dtype=np.int64).T
-
-            # data.edge_attr: Edge feature matrix with shape [num_edges, num_edge_features]
-            edge_attr = np.array(edge_features_list, dtype=np.int64)
-
+                edge_index[:, 2 * k] = (i, j)
+                edge_index[:, 2 * k + 1] = (j, i)
+                edge_attr[2 * k] = edge_feature
+                edge_attr[2 * k + 1] = edge_feature
 
         else:  # mol has no bonds
             return None
 
-        graph = Data(
-            x=x,
-            edge_index=edge_index,
-            edge_attr=edge_attr,
-            pos=coords,
-            z=z,
-        )
+        # coordinates as a single contiguous float32 array, ready for torch.from_numpy
+        coords = np.asarray(mol.GetConformer().GetPositions(), dtype=np.float32, order='C')
+
+        # plain arrays, so that worker processes do not send torch tensors back
+        graph = {
+            'x': x,
+            'edge_index': edge_index,
+            'edge_attr': edge_attr,
+            'pos': coords,
+            'z': z,
+        }
 
         return graph
+
+    @staticmethod
+    def collate(fields):
+        r"""
+        Concatenate the per-molecule arrays of each field into one tensor,
+        along with the number of nodes and edges of each molecule.
+
+        Every field starts from an empty array of the right shape, so that a
+        run without any valid molecule still gives an empty dataset.
+        """
+        empty = {
+            'x': np.empty((0, NUM_ATOM_FEATURES), dtype=np.int64),
+            'edge_index': np.empty((2, 0), dtype=np.int64),
+            'edge_attr': np.empty((0, NUM_BOND_FEATURES), dtype=np.int64),
+            'pos': np.empty((0, 3), dtype=np.float32),
+            'z': np.empty(0, dtype=np.int64),
+            'label': np.empty(0, dtype=np.float32),
+            'mask': np.empty(0, dtype=np.bool_),
+        }
+
+        # edge_index is stored as [2, num_edges], so it grows along its second axis
+        data = {
+            key: torch.from_numpy(np.concatenate([array] + fields[key], axis=1 if key == 'edge_index' else 0))
+            for key, array in empty.items()
+        }
+        data['num_nodes'] = torch.tensor([z.shape[0] for z in fields['z']], dtype=torch.long)
+        data['num_edges'] = torch.tensor([edge_index.shape[1] for edge_index in fields['edge_index']], dtype=torch.long)
+
+        return data
+
+    @staticmethod
+    def separate(data):
+        r"""
+        Split the output of :meth:`collate` back into per-molecule graphs,
+        labels and masks. The returned tensors are views into the collated ones.
+        """
+        num_nodes = data['num_nodes'].tolist()
+        num_edges = data['num_edges'].tolist()
+        if len(num_nodes) == 0:
+            return [], [], []
+
+        fields = zip(
+            data['x'].split(num_nodes),
+            data['edge_index'].split(num_edges, dim=1),
+            data['edge_attr'].split(num_edges),
+            data['pos'].split(num_nodes),
+            data['z'].split(num_nodes),
+        )
+        graph_list = [
+            Data(x=x, edge_index=edge_index, edge_attr=edge_attr, pos=pos, z=z)
+            for x, edge_index, edge_attr, pos, z in fields
+        ]
+        label_list = list(data['label'].split(num_nodes))
+        mask_list = list(data['mask'].split(num_nodes))
+
+        return graph_list, label_list, mask_list
     
 
 class CarbonDatasetBuilder(DatasetBuilder):
-    def __init__(self, root):
+    def __init__(self, root, num_workers=None):
         super().__init__(root)
-        
+        self.num_workers = num_workers or os.cpu_count()
+
     @property
     def raw_file_names(self):
         return "carbon_dataset.sdf"
@@ -118,12 +274,10 @@ class CarbonDatasetBuilder(DatasetBuilder):
         else:
             print("The processed data already exists. Loading the processed data...")
         
-        # load the processed data
-        data = torch.load(self.processed_paths)
+        # load the processed data, memory-mapping the tensor storages instead of copying them
+        data = torch.load(self.processed_paths, mmap=True, map_location='cpu', weights_only=True)
         
-        graph_list = data['graph_list']
-        label_list = data['label_list']
-        mask_list = data['mask_list']
+        graph_list, label_list, mask_list = self.separate(data)
         
         # create the dataset
         dataset = ChemicalShiftDataset(graph_list, label_list, mask_list)
@@ -140,52 +294,28 @@ class CarbonDatasetBuilder(DatasetBuilder):
         # logging the progress
         print("Processing the raw carbon data...")
         
-        # Load sdf file
-        suppl = Chem.SDMolSupplier(os.path.join(self.raw_dir, self.raw_file_names), removeHs=False, sanitize=True)
+        # read the sdf file record by record and process them in parallel
+        blocks = iter_mol_blocks(os.path.join(self.raw_dir, self.raw_file_names))
         print("The raw carbon data is being processed.")
         
-        # initialize the lists
-        graph_list = []
-        label_list = []
-        mask_list = []
-        
-        for mol in tqdm(suppl, desc="Processing data", total=len(suppl)):
-            if mol is None:
-                continue
-            
-            # Get graph data
-            graph = self.mol2graph(mol) 
-            if graph is None:
-                continue
-
-            # get the carbon shift
-            atom_shifts = self.get_carbon_shift(mol)
-            if len(atom_shifts) == 0:
-                continue
-            
-            # get the carbon atoms
-            for i, atom in enumerate(mol.GetAtoms()):
-                if i in atom_shifts:
-                    atom.SetProp('shift', str(atom_shifts[i]))
-                    atom.SetBoolProp('mask', True)
-                else:
-                    atom.SetProp('shift', str(0))
-                    atom.SetBoolProp('mask', False)
-
-            # get the label and mask
-            shift = np.array([ast.literal_eval(atom.GetProp('shift')) for atom in mol.GetAtoms()])
-            mask = np.array([atom.GetBoolProp('mask') for atom in mol.GetAtoms()])
-
-            if shift.shape[0] != mask.shape[0] != graph.number_of_nodes():
-                continue
-            
-            # save the data
-            graph_list.append(graph)
-            label_list.append(shift)
-            mask_list.append(mask)
-        
-        # save the processed data
-        data = {'graph_list': graph_list, 'label_list': label_list,'mask_list': mask_list}
+        # initialize one list of arrays per field
+        fields = {key: [] for key in ('x', 'edge_index', 'edge_attr', 'pos', 'z', 'label', 'mask')}
+        
+        with mp.Pool(processes=self.num_workers) as pool:
+            for result in tqdm(pool.imap(self._process_one, blocks, chunksize=64), desc="Processing data", unit="mol"):
+                if result is None:
+                    continue
+
+                graph, shift, mask = result
+
+                # save the data
+                for key, array in graph.items():
+                    fields[key].append(array)
+                fields['label'].append(shift)
+                fields['mask'].append(mask)
+        
+        # save the processed data as one contiguous tensor per field
+        data = self.collate(fields)
         os.makedirs(self.processed_dir, exist_ok=True)
         
         # save the dictionary
@@ -194,39 +324,79 @@ class CarbonDatasetBuilder(DatasetBuilder):
         # logging the progress
         print("The raw carbon data has been processed and saved.")
 
+    def _process_one(self, mol_block: str):
+        r"""
+        Process a single sdf record into a graph, its carbon shifts and mask.
+        Returns None if the molecule is invalid or has no carbon spectrum.
+        """
+        suppl = Chem.SDMolSupplier()
+        suppl.SetData(mol_block, removeHs=False, sanitize=True)
+        mol = suppl[0]
+        if mol is None:
+            return None
+        
+        # Get graph data
+        graph = self.mol2graph(mol) 
+        if graph is None:
+            return None
+
+        # get the carbon shift
+        atom_idxs, atom_shifts = self.get_carbon_shift(mol)
+        if len(atom_idxs) == 0:
+            return None
+        
+        # get the label and mask
+        num_atoms = mol.GetNumAtoms()
+        shift = np.zeros(num_atoms, dtype=np.float32)
+        mask = np.zeros(num_atoms, dtype=np.bool_)
+        shift[atom_idxs] = atom_shifts
+        mask[atom_idxs] = True
+
+        return graph, shift, mask
 
-    def get_carbon_shift(self, mol: Chem.rdchem.Mol) -> dict:
+    def get_carbon_shift(self, mol: Chem.rdchem.Mol) -> tuple:
         r"""
         Get the carbon shift of each carbon atom.
+
+        Returns the indices of the atoms that have a shift, in ascending order,
+        and the median of the shifts reported for each of them.
         """
-        mol_props = mol.GetPropsAsDict()
-        atom_shifts = {}
+        shift_values = []
+        shift_idxs = []
 
-        for key in mol_props.keys():
+        for key in mol.GetPropNames(includePrivate=False, includeComputed=False):
             if key.startswith('Spectrum 13C'):
-                for shift in mol_props[key].split('|')[:-1]:
+                for shift in mol.GetProp(key).split('|')[:-1]:
                     [shift_value, _, shift_idx] = shift.split(';')
-                    shift_value, shift_idx = float(shift_value), int(shift_idx)
-                    if shift_idx not in atom_shifts: 
-                        atom_shifts[shift_idx] = []
-                        
-                    atom_shifts[shift_idx].append(shift_value)
+                    shift_values.append(float(shift_value))
+                    shift_idxs.append(int(shift_idx))
+
+        vals = np.array(shift_values, dtype=np.float64)
+        idxs = np.array(shift_idxs, dtype=np.int64)
+
+        # drop shifts assigned to atoms outside the molecule
+        keep = (idxs >= 0) & (idxs < mol.GetNumAtoms())
+        vals, idxs = vals[keep], idxs[keep]
+
+        # sort by atom index, then by value, so the shifts of each atom form a sorted run
+        order = np.lexsort((vals, idxs))
+        vals, idxs = vals[order], idxs[order]
 
-        for j in range(mol.GetNumAtoms()):
-            if j in atom_shifts:
-                atom_shifts[j] = np.median(atom_shifts[j])
+        # the median of each run is the mean of its two middle values
+        atom_idxs, starts, counts = np.unique(idxs, return_index=True, return_counts=True)
+        atom_shifts = (vals[starts + (counts - 1) // 2] + vals[starts + counts // 2]) / 2
 
-        return atom_shifts
+        return atom_idxs, atom_shifts
 
 
 class ChemicalShiftDataset(Dataset):
     def __init__(self, graph_list, label_list, mask_list):
         # check the lengths of the lists
         assert len(graph_list) == len(label_list) == len(mask_list)
-        # save the data
-        self.graphs = graph_list
-        self.labels = label_list
-        self.masks = mask_list
+        # save the data as tuples, converting labels and masks to tensors once here
+        self.graphs = tuple(graph_list)
+        self.labels = tuple(torch.as_tensor(label) for label in label_list)
+        self.masks = tuple(torch.as_tensor(mask) for mask in mask_list)
         
     def __len__(self):
         return len(self.graphs)
@@ -23,16 +23,14 @@ def number(text):
     if text is None or text == "None":
         return None
 
-    try:
-        num_int = int(text)
-    except ValueError:
-        num_int = None
-    num_float = float(text)
-
-    if num_int == num_float:
-        return num_int
-
-    return num_float
+    # plain integers are parsed once, everything else goes straight to float
+    digits = text.strip().replace("_", "")
+    if digits[:1] in ("+", "-"):
+        digits = digits[1:]
+    if digits.isdigit():
+        return int(text)
+
+    return float(text)
 
 
 def save_argparse(